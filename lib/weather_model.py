@@ -3,28 +3,64 @@
 from __future__ import annotations
 
 import argparse
+import functools
 import json
+import math
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Dict
-import meteostat
+from typing import Dict, Optional, Tuple
 import numpy as np
 import pandas as pd
-import scipy
 
-# Add lib directory to path for local imports
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+# Historical daily records rarely change, so keep meteostat's on-disk station
+# files for a week (its default is one day) before downloading them again
+DAILY_CACHE_MAX_AGE = int(
+    os.environ.get("METEOSTAT_CACHE_MAX_AGE", 7 * 24 * 60 * 60)
+)
 
-METRICS = [
-    "very hot",
-    "very cold",
-    "very windy",
-    "very wet",
-    "very uncomfortable",
-]
+# Minimum time in seconds between sweeps of meteostat's on-disk cache
+CACHE_CLEAN_INTERVAL = 24 * 60 * 60
+
+# Concurrent station downloads in get_weather_probabilities_bulk
+BULK_MAX_WORKERS = 8
+
+# Daily columns used by probability_calculator
+DAILY_COLUMNS = ["tmin", "tmax", "prcp", "wspd"]
+
+# Size of the station grid index cells, in degrees
+STATION_GRID_CELL = 1.0
+STATION_GRID_LON_CELLS = round(360 / STATION_GRID_CELL)
+
+# Rings of grid cells probed around a query before scanning every station
+STATION_GRID_MAX_RINGS = 3
+
+EARTH_RADIUS_KM = 6371.0
+
+# Error reported for locations without usable station data
+NO_DATA_ERROR = "No data available for this location"
+
+# Result keys, in the order returned by probability_calculator
+PROBABILITY_KEYS = ["hot_prob", "cold_prob", "too_rainy", "too_windy"]
+
+
+# Imports and configures meteostat on first use, so invalid queries and
+# callers of the calculation helpers never load it
+@functools.lru_cache(maxsize=1)
+def load_meteostat():
+    import meteostat
+
+    meteostat.Daily.max_age = DAILY_CACHE_MAX_AGE
+
+    # Meteostat sweeps its whole cache directory after every Daily fetch,
+    # which races when stations are fetched from several threads;
+    # clean_station_cache sweeps once per query instead
+    meteostat.Daily.autoclean = False
+    return meteostat
 
 
 @dataclass
@@ -34,113 +70,292 @@ class WeatherQuery:
     user_datetime: str
 
 
-# Receives latitude, longitude and day of interest, returns a dataframe with all available data from nearest weatherstation
-def get_meteostat_data(lat: float, lon: float):
-    # Find the closest weather station and its date range
-    stations = meteostat.Stations()
-    stations = stations.nearby(lat, lon)
-    stations_data = stations.fetch(limit=1)  # Get only the closest station
+# Great-circle distance in km between a point and arrays of points
+def haversine_km(lat, lon, lats, lons):
+    lat, lon, lats, lons = map(np.radians, (lat, lon, lats, lons))
+    arch = (
+        np.sin((lats - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(arch))
 
-    # Get information about the closest station
-    closest_station = None
-    if not stations_data.empty:
-        station_id, station = next(stations_data.iterrows())
-        distance_km = (
-            station.get("distance", 0) / 1000 if station.get("distance") else 0
+
+# Grid cell of a coordinate in the station grid index
+def station_grid_cell(lat: float, lon: float) -> Tuple[int, int]:
+    return (
+        int(np.floor(lat / STATION_GRID_CELL)),
+        int(np.floor(lon / STATION_GRID_CELL)) % STATION_GRID_LON_CELLS,
+    )
+
+
+@dataclass
+class StationGrid:
+    stations: pd.DataFrame
+    lats: np.ndarray
+    lons: np.ndarray
+    cells: Dict[Tuple[int, int], np.ndarray]
+
+
+# Loads all weather stations once per process and buckets their row positions
+# by grid cell; every lookup shares this instance
+@functools.lru_cache(maxsize=1)
+def get_station_grid() -> StationGrid:
+    stations = load_meteostat().Stations().fetch()
+    stations = stations.dropna(subset=["latitude", "longitude"])
+    lats = stations["latitude"].to_numpy(dtype=float)
+    lons = stations["longitude"].to_numpy(dtype=float)
+
+    lat_cell = np.floor(lats / STATION_GRID_CELL).astype(int)
+    lon_cell = np.floor(lons / STATION_GRID_CELL).astype(int) % STATION_GRID_LON_CELLS
+    cells = pd.Series(np.arange(len(stations))).groupby([lat_cell, lon_cell]).indices
+    return StationGrid(stations=stations, lats=lats, lons=lons, cells=cells)
+
+
+# Returns the row position and distance in km of the station closest to a point
+def find_closest_station(lat: float, lon: float) -> Tuple[int, float]:
+    grid = get_station_grid()
+    lat_cell, lon_cell = station_grid_cell(lat, lon)
+
+    # Probe growing squares of cells around the query (3x3, 5x5, ...)
+    for rings in range(1, STATION_GRID_MAX_RINGS + 1):
+        cells = [
+            (lat_cell + i, (lon_cell + j) % STATION_GRID_LON_CELLS)
+            for i in range(-rings, rings + 1)
+            for j in range(-rings, rings + 1)
+        ]
+        candidates = [grid.cells[cell] for cell in cells if cell in grid.cells]
+        if not candidates:
+            continue
+
+        candidates = np.concatenate(candidates)
+        distances = haversine_km(
+            lat, lon, grid.lats[candidates], grid.lons[candidates]
         )
-        closest_station = {
-            "station_id": station_id,
-            "name": station.get("name", "Unknown"),
-            "distance_km": round(distance_km, 2),
-            "start_date": station.get("daily_start").strftime("%Y-%m-%d")
-            if station.get("daily_start")
-            else None,
-            "end_date": station.get("daily_end").strftime("%Y-%m-%d")
-            if station.get("daily_end")
-            else None,
-        }
+        best = np.argmin(distances)
+
+        # Any station outside the probed cells is at least this far away
+        reach = np.radians(rings * STATION_GRID_CELL)
+        lon_reach = np.arcsin(
+            min(1.0, np.cos(np.radians(lat)) * np.sin(min(reach, np.pi / 2)))
+        )
+        if distances[best] <= EARTH_RADIUS_KM * min(reach, lon_reach):
+            return int(candidates[best]), float(distances[best])
+
+    # Sparse area: scan every station
+    distances = haversine_km(lat, lon, grid.lats, grid.lons)
+    best = np.argmin(distances)
+    return int(best), float(distances[best])
+
+
+# Receives latitude and longitude, returns details of the nearest weatherstation
+@functools.lru_cache(maxsize=256)
+def get_closest_station(lat: float, lon: float) -> Optional[Dict[str, object]]:
+    stations = get_station_grid().stations
+    if stations.empty:
+        return None
+
+    # Get information about the closest station
+    position, distance_km = find_closest_station(lat, lon)
+
+    # Like meteostat.Point, only use stations within its search radius
+    if distance_km > load_meteostat().Point.radius / 1000:
+        return None
+
+    station_id, station = stations.index[position], stations.iloc[position]
+    return {
+        "station_id": station_id,
+        "name": station.get("name", "Unknown"),
+        "distance_km": round(distance_km, 2),
+        # Inventory timestamps are kept as-is and passed straight to
+        # get_location_data, with no string formatting round trip
+        "start_date": station.get("daily_start"),
+        "end_date": station.get("daily_end"),
+    }
 
-    if closest_station:
-        # Fetch daily data only within the station's valid date range
-        location = meteostat.Point(lat, lon)
-        start_date = datetime.strptime(closest_station["start_date"], "%Y-%m-%d")
-        end_date = datetime.strptime(closest_station["end_date"], "%Y-%m-%d")
 
-        # Fetch data within the valid range
-        data = meteostat.Daily(location, start_date, end_date)
-        daily_data = data.fetch()
+# Returns a dataframe with all available daily data for a location
+@functools.lru_cache(maxsize=32)
+def get_location_data(lat: float, lon: float, start_date: datetime, end_date: datetime):
+    # A Point ranks up to Point.max_count stations nearby and fills each day's
+    # missing values from the next-ranked station; only the columns used by
+    # probability_calculator are kept
+    meteostat = load_meteostat()
+    data = meteostat.Daily(meteostat.Point(lat, lon), start_date, end_date)
+    daily_data = data.fetch().reindex(columns=DAILY_COLUMNS)
+
+    # Calendar day key used to match the same month/day across years
+    if not daily_data.empty:
+        daily_data["mmdd"] = month_day_key(daily_data.index)
+    return daily_data
+
+
+# Removes expired station files from meteostat's on-disk cache. The sweep
+# lists and stats every cached file, so it runs at most once per
+# CACHE_CLEAN_INTERVAL; other calls cost a single stat of the stamp file.
+def clean_station_cache() -> None:
+    daily = load_meteostat().Daily
+    stamp = os.path.join(daily.cache_dir, ".last_clean")
+    try:
+        if time.time() - os.path.getmtime(stamp) < CACHE_CLEAN_INTERVAL:
+            return
+    except FileNotFoundError:
+        pass
+
+    daily.clear_cache()
+    os.makedirs(daily.cache_dir, exist_ok=True)
+    with open(stamp, "a"):
+        os.utime(stamp)
+
+
+# Receives latitude, longitude and day of interest, returns a dataframe with all available data from nearest weatherstation
+def get_meteostat_data(lat: float, lon: float):
+    closest_station = get_closest_station(lat, lon)
+
+    if closest_station:
+        # Fetch daily data only within the closest station's valid date range
+        daily_data = get_location_data(
+            lat,
+            lon,
+            closest_station["start_date"],
+            closest_station["end_date"],
+        )
+        clean_station_cache()
 
     else:
-        print("No weather stations found near the specified coordinates.")
+        # stdout is reserved for the JSON result
+        print(
+            "No weather stations found near the specified coordinates.",
+            file=sys.stderr,
+        )
         daily_data = None
 
     return daily_data
 
 
-def probability_calculator(data) -> [float]:
-    probabilities = []
+# Cumulative distribution function of a normal distribution
+def normal_cdf(x: float, mu: float, sigma: float) -> float:
+    if sigma == 0:
+        # Degenerate distribution: all records share the same value
+        return 1.0 if x >= mu else 0.0
+    return 0.5 * (1.0 + math.erf((x - mu) / (sigma * math.sqrt(2.0))))
+
 
+def probability_calculator(data) -> np.ndarray:
     # thresholds for the model
     hot_threshold = 30
     cold_threshold = 0
     windspeed_threshold = 20
     rainy_threshold = 1
 
-    # Extract temperature data and remove NaN values
-    min_temp = data["tmin"].dropna()
-    max_temp = data["tmax"].dropna()
-    prcp = data["prcp"].dropna()
-    windspeed = data["wspd"].dropna()
-
-    # Creating binary values for rainy days
-    rainy_days = [1 if rain_amount >= rainy_threshold else 0 for rain_amount in prcp]
-
-    # Computing normal distributions
-    max_mu, max_sigma = scipy.stats.norm.fit(max_temp)
-    wind_mu, wind_sigma = scipy.stats.norm.fit(windspeed)
-    cold_mu, cold_sigma = scipy.stats.norm.fit(min_temp)
-
-    # Computing Probabilities -> Could make these a for loop
-    probabilities.append(
-        np.around(
-            np.clip(
-                1 - scipy.stats.norm.cdf(hot_threshold, loc=max_mu, scale=max_sigma),
-                0,
-                1,
-            )
-            * 100,
-            1,
-        )
-    )
-    probabilities.append(
-        np.around(
-            np.clip(
-                scipy.stats.norm.cdf(cold_threshold, loc=cold_mu, scale=cold_sigma),
-                0,
-                1,
-            )
-            * 100,
-            1,
-        )
-    )
-    probabilities.append(
-        np.around(np.clip(sum(rainy_days) / len(rainy_days), 0, 1) * 100, 1)
+    # Extract the daily columns as one (days, columns) float array
+    values = data[DAILY_COLUMNS].to_numpy(dtype=float, na_value=np.nan)
+    valid = ~np.isnan(values)
+    counts = valid.sum(axis=0)
+
+    # Columns without any values get NaN statistics instead of dividing by zero
+    has_values = counts > 0
+    divisors = np.maximum(counts, 1)
+
+    # Computing normal distributions (maximum likelihood: mean and population
+    # std) for every column at once, skipping NaN values
+    sums = np.where(valid, values, 0.0).sum(axis=0)
+    means = np.where(has_values, sums / divisors, np.nan)
+    squares = np.where(valid, (values - means) ** 2, 0.0).sum(axis=0)
+    stds = np.where(has_values, np.sqrt(squares / divisors), np.nan)
+    cold_mu, max_mu, _, wind_mu = means
+    cold_sigma, max_sigma, _, wind_sigma = stds
+
+    # Share of rainy days
+    rainy_share = (
+        np.count_nonzero(values[:, 2] >= rainy_threshold) / counts[2]
+        if has_values[2]
+        else np.nan
     )
-    probabilities.append(
-        np.around(
-            np.clip(
-                1
-                - scipy.stats.norm.cdf(
-                    windspeed_threshold, loc=wind_mu, scale=wind_sigma
-                ),
-                0,
-                1,
-            )
-            * 100,
-            1,
-        )
+
+    # Clip, scale and round all probabilities (hot, cold, rainy, windy)
+    # together, in place on a single array
+    probabilities = np.array(
+        [
+            1 - normal_cdf(hot_threshold, max_mu, max_sigma),
+            normal_cdf(cold_threshold, cold_mu, cold_sigma),
+            rainy_share,
+            1 - normal_cdf(windspeed_threshold, wind_mu, wind_sigma),
+        ]
     )
-    return probabilities
+    np.clip(probabilities, 0, 1, out=probabilities)
+    probabilities *= 100
+    return np.around(probabilities, 1, out=probabilities)
+
+
+# Returns month * 100 + day for every date of an index
+def month_day_key(index: pd.DatetimeIndex) -> np.ndarray:
+    return (index.month * 100 + index.day).to_numpy(dtype=np.int16)
+
+
+# Returns the row positions in daily data that fall on month/day in any year
+def matching_day_positions(daily_data, month: int, day: int) -> np.ndarray:
+    index = daily_data.index
+    if len(index) == 0:
+        return np.empty(0, dtype=np.intp)
+
+    # A gap-free daily index is a regular grid: position is the day offset.
+    # Point fetches are regrouped into 1-day bins, so this is the usual path.
+    first, last = index[0], index[-1]
+    if (
+        index.is_monotonic_increasing
+        and index.is_unique
+        and len(index) == (last - first).days + 1
+    ):
+        targets = []
+        for year in range(first.year, last.year + 1):
+            try:
+                targets.append(pd.Timestamp(year, month, day))
+            except ValueError:
+                # February 29th outside of leap years
+                continue
+        targets = pd.DatetimeIndex(targets)
+        targets = targets[(targets >= first) & (targets <= last)]
+        return (targets - first).days.to_numpy()
+
+    # Indexes with gaps or out-of-order rows compare a single month * 100 + day
+    # key instead of building two masks
+    if "mmdd" in daily_data:
+        mmdd = daily_data["mmdd"].to_numpy()
+    else:
+        mmdd = month_day_key(index)
+    return np.flatnonzero(mmdd == month * 100 + day)
+
+
+# Returns the number of records on each month/day across all years and their
+# probabilities, as one array per result key
+def day_probabilities(daily_data, months, days) -> Dict[str, np.ndarray]:
+    records_found = np.empty(len(months), dtype=int)
+    probabilities = np.empty((len(months), len(PROBABILITY_KEYS)))
+    for i, (month, day) in enumerate(zip(months, days)):
+        # Filter data for the same month and day across all years
+        matching_dates = daily_data.iloc[
+            matching_day_positions(daily_data, int(month), int(day))
+        ]
+        records_found[i] = len(matching_dates)
+        probabilities[i] = probability_calculator(matching_dates)
+
+    return {
+        "historical_records_found": records_found,
+        **dict(zip(PROBABILITY_KEYS, probabilities.T)),
+    }
+
+
+# Result for a query without station records for its location or calendar day
+def no_data_result(query: WeatherQuery) -> Dict[str, object]:
+    return {
+        "meta": {
+            "lat": query.lat,
+            "lon": query.lon,
+            "user_datetime": query.user_datetime,
+            "data_source": "meteostat",
+            "error": NO_DATA_ERROR,
+        }
+    }
 
 
 # Takes latitude, longitude, day of year, and returns various probabilities of interest
@@ -154,27 +369,25 @@ def get_weather_probabilities(
     daily_data = get_meteostat_data(float(lat), float(lon))
 
     if daily_data is None or daily_data.empty:
-        return {
-            "meta": {
-                "lat": query.lat,
-                "lon": query.lon,
-                "user_datetime": query.user_datetime,
-                "data_source": "meteostat",
-                "error": "No data available for this location",
-            }
-        }
+        return no_data_result(query)
 
     # Parse the user's target date
     target_date = datetime.strptime(query.user_datetime, "%Y-%m-%d")
     target_month = target_date.month
     target_day = target_date.day
 
-    # Filter data for the same month and day across all years
-    matching_dates = daily_data[
-        (daily_data.index.month == target_month) & (daily_data.index.day == target_day)
-    ]
+    # Single point adapter over the array results; a metric whose column has
+    # no values for this day is reported as null rather than NaN
+    results = {
+        key: None if np.isnan(values[0]) else values.tolist()[0]
+        for key, values in day_probabilities(
+            daily_data, [target_month], [target_day]
+        ).items()
+    }
 
-    too_hot, too_cold, too_rainy, too_windy = probability_calculator(matching_dates)
+    # No records fall on this calendar day (e.g. February 29th)
+    if results["historical_records_found"] == 0:
+        return no_data_result(query)
 
     # TODO: probabilities to 2 decimal places
 
@@ -185,16 +398,77 @@ def get_weather_probabilities(
             "user_datetime": query.user_datetime,
             "target_month": target_month,
             "target_day": target_day,
-            "historical_records_found": len(matching_dates),
+            "historical_records_found": results["historical_records_found"],
             "data_source": "meteostat",
-            "hot_prob": too_hot,
-            "cold_prob": too_cold,
-            "too_rainy": too_rainy,
-            "too_windy": too_windy,
+            "hot_prob": results["hot_prob"],
+            "cold_prob": results["cold_prob"],
+            "too_rainy": results["too_rainy"],
+            "too_windy": results["too_windy"],
         }
     }
 
 
+# Takes a dataframe with lat, lon and user_datetime columns, returns it with the
+# probabilities for every row. Each distinct location's history is fetched once.
+def get_weather_probabilities_bulk(points: pd.DataFrame) -> pd.DataFrame:
+    for user_datetime in points["user_datetime"]:
+        validate_user_datetime(user_datetime)
+    target_dates = pd.to_datetime(points["user_datetime"], format="%Y-%m-%d")
+
+    # Resolve each distinct location to its closest station
+    locations = list(zip(points["lat"].astype(float), points["lon"].astype(float)))
+    closest_stations = {
+        location: get_closest_station(*location) for location in set(locations)
+    }
+    location_rows = {}
+    for position, location in enumerate(locations):
+        location_rows.setdefault(location, []).append(position)
+
+    # Location histories are independent downloads, so fetch them concurrently
+    with ThreadPoolExecutor(max_workers=BULK_MAX_WORKERS) as executor:
+        futures = {
+            location: executor.submit(
+                get_location_data,
+                *location,
+                station["start_date"],
+                station["end_date"],
+            )
+            for location, station in closest_stations.items()
+            if station
+        }
+        location_data = {
+            location: future.result() for location, future in futures.items()
+        }
+    clean_station_cache()
+
+    # One array per output column, filled location by location
+    columns = {
+        "station_id": np.full(len(points), None, dtype=object),
+        "historical_records_found": np.full(len(points), np.nan),
+        **{key: np.full(len(points), np.nan) for key in PROBABILITY_KEYS},
+    }
+    has_data = np.zeros(len(points), dtype=bool)
+    month_days = month_day_key(pd.DatetimeIndex(target_dates)).astype(int)
+
+    for location, daily_data in location_data.items():
+        positions = np.array(location_rows[location])
+        columns["station_id"][positions] = closest_stations[location]["station_id"]
+        if daily_data.empty:
+            continue
+
+        # Probabilities only depend on the calendar day, so each location
+        # computes every distinct month/day once
+        keys, inverse = np.unique(month_days[positions], return_inverse=True)
+        day_results = day_probabilities(daily_data, keys // 100, keys % 100)
+        for key, values in day_results.items():
+            columns[key][positions] = values[inverse]
+        has_data[positions] = day_results["historical_records_found"][inverse] > 0
+
+    # Rows without station data keep empty results and share one error value
+    columns["error"] = np.where(has_data, None, NO_DATA_ERROR)
+    return points.assign(**columns)
+
+
 # Ensuring user input is valid
 def validate_user_datetime(user_datetime: str) -> None:
     try:
@@ -214,7 +488,7 @@ def parse_args() -> argparse.Namespace:
 def main() -> None:
     args = parse_args()
     result = get_weather_probabilities(args.lat, args.lon, args.datetime)
-    print(json.dumps(result))
+    print(json.dumps(result, allow_nan=False))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,317 @@
+import json
+import os
+import statistics
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "lib")
+)
+
+import weather_model  # noqa: E402
+
+
+@pytest.fixture
+def station_grid(monkeypatch):
+    rng = np.random.default_rng(42)
+    lats = np.concatenate(
+        [
+            rng.uniform(-90, 90, 3000),
+            # Clusters near the poles and on both sides of the ±180° meridian
+            rng.uniform(85, 90, 200),
+            rng.uniform(-90, -85, 200),
+            rng.uniform(-60, 60, 400),
+        ]
+    )
+    lons = np.concatenate(
+        [
+            rng.uniform(-180, 180, 3400),
+            rng.choice([-1, 1], 400) * rng.uniform(175, 180, 400),
+        ]
+    )
+    stations = pd.DataFrame(
+        {"latitude": lats, "longitude": lons},
+        index=pd.Index([f"S{i}" for i in range(len(lats))], name="id"),
+    )
+
+    fake_meteostat = SimpleNamespace(
+        Stations=lambda: SimpleNamespace(fetch=lambda: stations.copy())
+    )
+    monkeypatch.setattr(weather_model, "load_meteostat", lambda: fake_meteostat)
+    grid = weather_model.get_station_grid.__wrapped__()
+    monkeypatch.setattr(weather_model, "get_station_grid", lambda: grid)
+    return grid
+
+
+def test_find_closest_station_matches_full_scan(station_grid):
+    rng = np.random.default_rng(7)
+    queries = [
+        (89.95, 0.0),
+        (-89.95, 120.0),
+        (87.0, 179.99),
+        (-88.0, -179.99),
+        (0.0, 180.0),
+        (0.0, -180.0),
+        (45.0, 179.5),
+        (-30.0, -179.5),
+    ]
+    queries += list(zip(rng.uniform(-90, 90, 500), rng.uniform(-180, 180, 500)))
+    meridian_lons = rng.choice([-1, 1], 200) * rng.uniform(178, 180, 200)
+    queries += list(zip(rng.uniform(-90, 90, 200), meridian_lons))
+
+    for lat, lon in queries:
+        distances = weather_model.haversine_km(
+            lat, lon, station_grid.lats, station_grid.lons
+        )
+        position, distance_km = weather_model.find_closest_station(lat, lon)
+        assert distance_km == pytest.approx(distances.min()), (lat, lon)
+        assert distances[position] == pytest.approx(distances.min()), (lat, lon)
+
+
+def daily_history(start, end, seed):
+    rng = np.random.default_rng(seed)
+    index = pd.date_range(start, end, freq="D", name="time")
+    n = len(index)
+    return pd.DataFrame(
+        {
+            "tmin": rng.normal(10, 8, n),
+            "tmax": rng.normal(25, 6, n),
+            "prcp": rng.exponential(2, n),
+            "wspd": rng.normal(12, 6, n),
+        },
+        index=index,
+    ).astype("Float64")
+
+
+@pytest.fixture
+def fake_meteostat(monkeypatch, tmp_path):
+    stations = pd.DataFrame(
+        {
+            "latitude": [10.0, -20.0],
+            "longitude": [10.0, 50.0],
+            "name": ["Alpha", "Bravo"],
+            "daily_start": pd.to_datetime(["1990-01-01", "2001-01-01"]),
+            "daily_end": pd.to_datetime(["2024-12-31", "2003-12-31"]),
+        },
+        index=pd.Index(["A", "B"], name="id"),
+    )
+    histories = {
+        (10.0, 10.0): daily_history("1990-01-01", "2024-12-31", 1),
+        (10.1, 10.1): daily_history("1990-01-01", "2024-12-31", 2).iloc[0:0],
+        # No leap years, so February 29th has no records
+        (-20.0, 50.0): daily_history("2001-01-01", "2003-12-31", 3),
+    }
+    fetched = []
+
+    class Point:
+        radius = 35000
+
+        def __init__(self, lat, lon):
+            self.location = (lat, lon)
+
+    class Daily:
+        cache_dir = str(tmp_path)
+
+        def __init__(self, loc, start, end):
+            fetched.append(loc.location)
+            self._data = histories[loc.location]
+
+        def fetch(self):
+            return self._data.copy()
+
+        @classmethod
+        def clear_cache(cls):
+            pass
+
+    fake = SimpleNamespace(
+        Stations=lambda: SimpleNamespace(fetch=lambda: stations.copy()),
+        Point=Point,
+        Daily=Daily,
+        fetched=fetched,
+    )
+    cached = (
+        weather_model.get_station_grid,
+        weather_model.get_closest_station,
+        weather_model.get_location_data,
+    )
+    for function in cached:
+        function.cache_clear()
+    monkeypatch.setattr(weather_model, "load_meteostat", lambda: fake)
+    yield fake
+    for function in cached:
+        function.cache_clear()
+
+
+def test_bulk_matches_single_point_queries(fake_meteostat):
+    points = pd.DataFrame(
+        {
+            "lat": [10.0, 10.0, -20.0, 10.0],
+            "lon": [10.0, 10.0, 50.0, 10.0],
+            "user_datetime": ["2020-07-04", "2021-01-15", "2002-03-01", "1999-07-04"],
+        },
+        index=[7, 3, 9, 1],
+    )
+    results = weather_model.get_weather_probabilities_bulk(points)
+
+    assert list(results.index) == [7, 3, 9, 1]
+    assert results["error"].isna().all()
+    assert list(results["station_id"]) == ["A", "A", "B", "A"]
+    for row_index, row in points.iterrows():
+        meta = weather_model.get_weather_probabilities(
+            row["lat"], row["lon"], row["user_datetime"]
+        )["meta"]
+        for key in ["historical_records_found", *weather_model.PROBABILITY_KEYS]:
+            assert results.loc[row_index, key] == meta[key], (row_index, key)
+
+    # Rows sharing a calendar day share a result
+    assert (
+        results.loc[7, weather_model.PROBABILITY_KEYS]
+        == results.loc[1, weather_model.PROBABILITY_KEYS]
+    ).all()
+
+
+def test_bulk_fetches_each_location_once(fake_meteostat):
+    points = pd.DataFrame(
+        {
+            "lat": [10.0, -20.0, 10.0, -20.0],
+            "lon": [10.0, 50.0, 10.0, 50.0],
+            "user_datetime": ["2020-07-04", "2002-03-01", "2021-01-15", "2003-06-01"],
+        }
+    )
+    weather_model.get_weather_probabilities_bulk(points)
+    assert sorted(fake_meteostat.fetched) == [(-20.0, 50.0), (10.0, 10.0)]
+
+
+def test_bulk_reports_rows_without_data(fake_meteostat):
+    points = pd.DataFrame(
+        {
+            # No station in range, empty history, no February 29th records
+            "lat": [60.0, 10.1, -20.0],
+            "lon": [-100.0, 10.1, 50.0],
+            "user_datetime": ["2020-07-04", "2020-07-04", "2004-02-29"],
+        }
+    )
+    results = weather_model.get_weather_probabilities_bulk(points)
+
+    assert list(results["error"]) == [weather_model.NO_DATA_ERROR] * 3
+    assert list(results["station_id"]) == [None, "A", "B"]
+    assert results[weather_model.PROBABILITY_KEYS].isna().all().all()
+
+
+def test_bulk_with_no_points(fake_meteostat):
+    results = weather_model.get_weather_probabilities_bulk(
+        pd.DataFrame({"lat": [], "lon": [], "user_datetime": []})
+    )
+    assert results.empty
+    assert "error" in results
+
+
+@pytest.mark.parametrize("month, day", [(1, 1), (2, 28), (2, 29), (7, 4), (12, 31)])
+def test_matching_day_positions_matches_masks(month, day):
+    history = daily_history("1990-03-01", "2024-02-28", 4)
+    rng = np.random.default_rng(5)
+    frames = [
+        # Regular daily index (day offset path)
+        history,
+        # Gaps, shuffled rows and a precomputed key (month/day key path)
+        history[rng.random(len(history)) < 0.7],
+        history.sample(frac=1.0, random_state=6),
+        history.assign(mmdd=weather_model.month_day_key(history.index)).iloc[::3],
+        history.iloc[0:0],
+    ]
+    for frame in frames:
+        expected = frame[(frame.index.month == month) & (frame.index.day == day)]
+        positions = weather_model.matching_day_positions(frame, month, day)
+        assert frame.iloc[positions].index.equals(expected.index)
+
+
+def reference_probabilities(data):
+    # Normal fits as in the original scipy.stats.norm implementation
+    def tail(column, threshold):
+        values = data[column].dropna().astype(float)
+        fit = statistics.NormalDist(statistics.fmean(values), statistics.pstdev(values))
+        return fit.cdf(threshold)
+
+    prcp = data["prcp"].dropna()
+    probabilities = [
+        1 - tail("tmax", 30),
+        tail("tmin", 0),
+        (prcp >= 1).sum() / len(prcp),
+        1 - tail("wspd", 20),
+    ]
+    return [round(min(max(p, 0), 1) * 100, 1) for p in probabilities]
+
+
+@pytest.mark.filterwarnings("error")
+def test_probability_calculator_matches_normal_fit():
+    history = daily_history("1990-01-01", "2024-12-31", 8)
+    rng = np.random.default_rng(9)
+    for column in weather_model.DAILY_COLUMNS:
+        history.loc[rng.random(len(history)) < 0.1, column] = pd.NA
+
+    for month, day in [(1, 15), (2, 29), (7, 4), (12, 31)]:
+        sample = history[(history.index.month == month) & (history.index.day == day)]
+        np.testing.assert_allclose(
+            weather_model.probability_calculator(sample),
+            reference_probabilities(sample),
+            atol=0.1,
+        )
+
+
+@pytest.mark.filterwarnings("error")
+def test_probability_calculator_all_nan_column():
+    complete = daily_history("2000-01-01", "2000-01-30", 10)
+    sample = complete.copy()
+    sample["wspd"] = pd.array([pd.NA] * len(sample), dtype="Float64")
+    probabilities = weather_model.probability_calculator(sample)
+
+    # Only the windy probability depends on the missing column
+    assert np.isnan(probabilities[3])
+    np.testing.assert_allclose(
+        probabilities[:3], reference_probabilities(complete)[:3], atol=0.1
+    )
+
+
+@pytest.mark.filterwarnings("error")
+def test_probability_calculator_empty_slice():
+    sample = daily_history("2000-01-01", "2000-01-30", 11).iloc[0:0]
+    assert np.isnan(weather_model.probability_calculator(sample)).all()
+
+
+@pytest.mark.filterwarnings("error")
+def test_probability_calculator_single_record():
+    sample = pd.DataFrame(
+        {"tmin": [5.0], "tmax": [35.0], "prcp": [2.0], "wspd": [10.0]},
+        index=pd.DatetimeIndex(["2000-07-04"], name="time"),
+    )
+    # Zero spread: each probability is a step at the single recorded value
+    assert list(weather_model.probability_calculator(sample)) == [
+        100.0,
+        0.0,
+        100.0,
+        0.0,
+    ]
+
+
+def test_main_prints_strict_json(monkeypatch, capsys):
+    history = daily_history("1990-01-01", "2024-12-31", 12)
+    history["wspd"] = pd.array([pd.NA] * len(history), dtype="Float64")
+    monkeypatch.setattr(weather_model, "get_meteostat_data", lambda lat, lon: history)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["weather_model.py", "--lat", "10", "--lon", "10", "--datetime", "2020-07-04"],
+    )
+    weather_model.main()
+
+    def reject(constant):
+        raise ValueError(f"non-standard JSON constant {constant}")
+
+    meta = json.loads(capsys.readouterr().out, parse_constant=reject)["meta"]
+    assert meta["too_windy"] is None
+    assert meta["historical_records_found"] == 35
+    assert "error" not in meta